@@ -1,5 +1,5 @@
 # Standard lib
-from collections import defaultdict, Counter, OrderedDict
+from collections import defaultdict, Counter, OrderedDict, deque
 import array
 import time
 
@@ -15,8 +15,13 @@ import pickle
 from deap import base, creator, algorithms, tools
 
 # Parallelization
-from pathos.multiprocessing import ProcessingPool as Pool
+from pathos.helpers import ProcessPool, mp
 import multiprocessing
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    # Only available from Python 3.8 onwards
+    shared_memory = None
 
 # ML
 from sklearn.base import BaseEstimator, TransformerMixin
@@ -58,21 +63,111 @@ class LRUCache:
         self.cache = OrderedDict()
 
     def get(self, key):
+        # Reorder in place instead of deleting and re-inserting the entry
         try:
-            value = self.cache.pop(key)
-            self.cache[key] = value
-            return value
+            self.cache.move_to_end(key)
         except KeyError:
             return None
+        return self.cache[key]
 
     def set(self, key, value):
-        try:
-            self.cache.pop(key)
-        except KeyError:
-            if len(self.cache) >= self.capacity:
-                self.cache.popitem(last=False)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+        elif len(self.cache) >= self.capacity:
+            self.cache.popitem(last=False)
         self.cache[key] = value
 
+def _eval_population(X, y, population, fitness, cache, verbose=False):
+    """Evaluate a list of shapelet sets. For `logloss_fitness`, the
+    distances for all shapelets that are not cached yet are calculated
+    with one `_pdist` call and stored in the cache, so the fitness function
+    only needs lookups. Shapelets that occur in multiple individuals are
+    only computed once. Other fitness functions may store something else
+    in the cache (or need more than the distances), so they are called
+    directly."""
+    if fitness is not logloss_fitness:
+        return [fitness(X, y, shaps, verbose=verbose, cache=cache)
+                for shaps in population]
+
+    missing = OrderedDict()
+    for shapelets in population:
+        for shap in shapelets:
+            shap_hash = hash(tuple(shap.flatten()))
+            if shap_hash not in missing and cache.get(shap_hash) is None:
+                missing[shap_hash] = shap.flatten()
+
+    if len(missing):
+        D = np.zeros((len(X), len(missing)))
+        _pdist(X, list(missing.values()), D)
+        for shap_ix, shap_hash in enumerate(missing):
+            cache.set(shap_hash, D[:, shap_ix])
+
+    return [fitness(X, y, shaps, verbose=verbose, cache=cache)
+            for shaps in population]
+
+def _set_fitness_values(population, fitnesses, weights):
+    """Weigh all fitness values at once and write them to the individuals.
+    Assigning `wvalues` directly skips the DEAP `values` setter, which
+    would weigh every individual separately."""
+    if len(population) == 0:
+        return
+    values = np.asarray(fitnesses, dtype=float)
+    if values.shape != (len(population), len(weights)):
+        raise ValueError('Expected {} fitness values for each of the {} '
+                         'individuals, got an array of shape {}'.format(
+                             len(weights), len(population), values.shape))
+    wvalues = values * weights
+    for ind, ind_wvalues in zip(population, wvalues):
+        ind.fitness.wvalues = tuple(ind_wvalues)
+
+def _select_fittest(population):
+    """Return the fittest individual without sorting the population. Like
+    `tools.selBest`, the weighted values are compared lexicographically
+    and the first individual wins ties. With NaN values, the outcome of
+    `tools.selBest` depends on the order of the population, so it is used
+    directly in that case."""
+    wvalues = np.array([ind.fitness.wvalues for ind in population])
+    if np.isnan(wvalues).any():
+        return tools.selBest(population, 1)[0]
+    candidates = np.arange(len(population))
+    for col in wvalues.T:
+        col = col[candidates]
+        candidates = candidates[col == col.max()]
+    return population[candidates[0]]
+
+# State of a worker process, bound once by `_init_worker`
+_worker_state = None
+_worker_shm = None
+
+def _init_worker(X, y, fitness, cache_size, verbose):
+    """Store the data, fitness function and a cache in a worker process, so
+    they do not have to be sent along with every task. `X` is either an
+    array or a (name, shape, dtype, forked) tuple of a shared memory block."""
+    global _worker_state, _worker_shm
+    if isinstance(X, tuple):
+        name, shape, dtype, forked = X
+        _worker_shm = shared_memory.SharedMemory(name=name)
+        # The block is owned by the parent. Attaching registers it with the
+        # resource tracker, and a worker that was not forked has a tracker
+        # of its own, which would unlink the block when the worker exits
+        if not forked:
+            resource_tracker.unregister(_worker_shm._name, 'shared_memory')
+        mp.util.Finalize(None, _close_worker_shm, exitpriority=0)
+        X = np.ndarray(shape, dtype=dtype, buffer=_worker_shm.buf)
+    _worker_state = (X, y, fitness, LRUCache(cache_size), verbose)
+
+def _close_worker_shm():
+    """Detach a worker from the shared memory block when it exits"""
+    global _worker_state
+    # Release the view on the buffer first, otherwise it cannot be closed
+    _worker_state = None
+    _worker_shm.close()
+
+def _worker_eval(population):
+    """Evaluate a chunk of shapelet sets inside a worker process"""
+    X, y, fitness, cache, verbose = _worker_state
+    return _eval_population(X, y, population, fitness, cache, verbose=verbose)
+
 class GeneticExtractor(BaseEstimator, TransformerMixin):
     """Feature selection with genetic algorithm.
 
@@ -87,7 +182,10 @@ class GeneticExtractor(BaseEstimator, TransformerMixin):
         The maximum number of generations the algorithm may run.
 
     wait : int
-        If no improvement has been found for `wait` iterations, then stop
+        If no improvement has been found for `wait` iterations, then stop.
+        Also stop when the population has converged: all fitness values are
+        equal, or the average stayed within 1% of the maximum for `wait`
+        iterations
 
     add_noise_prob : float
         The chance that gaussian noise is added to a random shapelet from a
@@ -178,27 +276,29 @@ class GeneticExtractor(BaseEstimator, TransformerMixin):
 
     def _convert_X(self, X):
         if isinstance(X, list):
-            for i in range(len(X)):
-                X[i] = np.array(X[i])
-            X = np.array(X)
+            if len(set(len(x) for x in X)) == 1:
+                # Equal lengths: build the 2D array in one vectorized call
+                X = np.array(X)
+            else:
+                X = np.array([np.array(x) for x in X])
 
         if isinstance(X, pd.DataFrame):
             X = X.values
 
         if X.dtype != object:
-            return X.view(np.float64)
+            # Row-contiguous float64, as the distance kernel scans one row at
+            # a time. This only copies when the dtype or layout differs.
+            return np.ascontiguousarray(X, dtype=np.float64)
         else:
             return X
 
     def _convert_y(self, y):
-        # Map labels to [0, ..., C-1]
-        for j, c in enumerate(np.unique(y)):
-            self.label_mapping[c] = j
-
-        # Use pandas map function and convert to numpy
-        y = np.reshape(pd.Series(y).map(self.label_mapping).values, (-1, 1))
+        # Map labels to [0, ..., C-1], the inverse indices of np.unique are
+        # exactly the mapped labels, so no separate mapping pass is needed
+        classes, y = np.unique(y, return_inverse=True)
+        self.label_mapping.update(zip(classes, range(len(classes))))
 
-        return y
+        return np.reshape(y, (-1, 1))
 
     def fit(self, X, y):
         """Extract shapelets from the provided timeseries and labels.
@@ -239,7 +339,10 @@ class GeneticExtractor(BaseEstimator, TransformerMixin):
         # Individual are lists (of shapelets (list))
         creator.create("Individual", list, fitness=creator.FitnessMax)
 
-        cache = LRUCache(2048)
+        # Cache the distance column of every shapelet, large enough to hold
+        # a few generations, as shapelets are often reused after crossover
+        cache_size = max(2048, 4 * self.population_size * self.max_shaps)
+        cache = LRUCache(cache_size)
 
         # Keep a history of the evolution
         self.history = []
@@ -249,7 +352,9 @@ class GeneticExtractor(BaseEstimator, TransformerMixin):
             if n_shapelets is None:
                 n_shapelets = np.random.randint(2, self.max_shaps)
 
-            init_op = np.random.choice(self.init_ops)
+            # Index the list directly, np.random.choice would first convert
+            # it into an object array on every call
+            init_op = self.init_ops[np.random.randint(len(self.init_ops))]
             return init_op(X, n_shapelets, self._min_length, self.max_len)
 
         # Register all operations in the toolbox
@@ -258,12 +363,23 @@ class GeneticExtractor(BaseEstimator, TransformerMixin):
         if self.n_jobs == -1:
             self.n_jobs = multiprocessing.cpu_count()
 
-        if self.n_jobs > 1:
-            pool = Pool(self.n_jobs)
-            toolbox.register("map", pool.map)
-        else:
-            toolbox.register("map", map)
+        # Workers are started once and keep their own copy of the data and
+        # cache for the entire run. They are created at the start of the
+        # `try` block below, so they are always cleaned up.
+        pool, shm = None, None
+
+        def evaluate(population):
+            """Calculate the fitness values of a list of individuals"""
+            if pool is None:
+                return _eval_population(X, y, population, self.fitness,
+                                        cache, verbose=self.verbose)
 
+            # Send chunks of plain lists, which are evaluated in batch
+            chunksize = max(1, len(population) // (self.n_jobs * 4))
+            chunks = [[list(ind) for ind in population[i:i + chunksize]]
+                      for i in range(0, len(population), chunksize)]
+            return [fit for chunk_fits in pool.map(_worker_eval, chunks)
+                    for fit in chunk_fits]
 
         # Register all our operations to the DEAP toolbox
         toolbox.register("merge", merge_crossover)
@@ -280,132 +396,189 @@ class GeneticExtractor(BaseEstimator, TransformerMixin):
                          toolbox.create)
         toolbox.register("population", tools.initRepeat, list, 
                          toolbox.individual)
-        toolbox.register("evaluate", 
-                         lambda shaps: self.fitness(X, y, shaps, 
-                                                    verbose=self.verbose, 
-                                                    cache=cache))
+        toolbox.register("evaluate", evaluate)
         # Small tournaments to ensure diversity
         toolbox.register("select", tools.selTournament, tournsize=3)  
 
-        # Set up the statistics. We will measure the mean, std dev and max
+        # Set up the statistics. We will measure the mean, std dev and max.
+        # NaN values are ignored, so a single failed evaluation does not
+        # turn the statistics (and best score tracking) into NaN
         stats = tools.Statistics(key=lambda ind: ind.fitness.values[0])
-        stats.register("avg", np.mean)
-        stats.register("std", np.std)
-        stats.register("max", np.max)
-        stats.register("min", np.min)
-        stats.register("q25", lambda x: np.quantile(x, 0.25))
-        stats.register("q75", lambda x: np.quantile(x, 0.75))
-
-        # Initialize the population and calculate their initial fitness values
-        start = time.time()
-        pop = toolbox.population(n=self.population_size)
-        fitnesses = list(map(toolbox.evaluate, pop))
-        for ind, fit in zip(pop, fitnesses):
-            ind.fitness.values = fit
-
-        # Keep track of the best iteration, in order to do stop after `wait`
-        # generations without improvement
-        it, best_it = 1, 1
-        best_ind = []
-        best_score = float('-inf')
-
-        # Set up a matplotlib figure and set the axes
-        height = int(np.ceil(self.population_size/4))
-        if self.plot is not None and self.plot != 'notebook':
-            if self.population_size <= 20:
-                f, ax = plt.subplots(4, height, sharex=True)
-            else:
-                plt.figure(figsize=(15, 5))
-                plt.xlim([0, len(X[0])])
-
-        # The genetic algorithm starts here
-        while it <= self.iterations and it - best_it < self.wait:
-            gen_start = time.time()
-
-            # Clone the population into offspring
-            offspring = list(map(toolbox.clone, pop))
+        stats.register("avg", np.nanmean)
+        stats.register("std", np.nanstd)
+        stats.register("max", np.nanmax)
+        stats.register("min", np.nanmin)
+        stats.register("q25", lambda x: np.nanquantile(x, 0.25))
+        stats.register("q75", lambda x: np.nanquantile(x, 0.75))
 
-            # Plot the fittest individual of our population
-            if self.plot is not None:
+        try:
+            if self.n_jobs > 1:
+                # Put X in shared memory, so the workers can attach to it
+                # instead of receiving a copy
+                worker_X = X
+                if shared_memory is not None and X.dtype != object:
+                    shm = shared_memory.SharedMemory(create=True,
+                                                     size=X.nbytes)
+                    np.ndarray(X.shape, dtype=X.dtype, buffer=shm.buf)[:] = X
+                    worker_X = (shm.name, X.shape, X.dtype,
+                                mp.get_start_method() == 'fork')
+
+                # Split the cache budget over the workers, so the total
+                # memory does not grow with n_jobs
+                worker_cache_size = max(1, cache_size // self.n_jobs)
+                pool = ProcessPool(self.n_jobs, initializer=_init_worker,
+                                   initargs=(worker_X, y, self.fitness,
+                                             worker_cache_size, self.verbose))
+
+            # Initialize the population and calculate their fitness values
+            start = time.time()
+            pop = toolbox.population(n=self.population_size)
+            _set_fitness_values(pop, toolbox.evaluate(pop), weights)
+
+            # Keep track of the best iteration, in order to do stop after `wait`
+            # generations without improvement
+            it, best_it = 1, 1
+
+            # Keep the (max, avg) fitness of the last `wait` generations, to
+            # stop early once the population has converged
+            recent_fitness = deque(maxlen=self.wait)
+            best_ind = []
+            best_score = float('-inf')
+
+            # Set up a matplotlib figure and set the axes
+            height = int(np.ceil(self.population_size/4))
+            if self.plot is not None and self.plot != 'notebook':
                 if self.population_size <= 20:
-                    if self.plot == 'notebook':
-                        f, ax = plt.subplots(4, height, sharex=True)
-                    for ix, ind in enumerate(offspring):
-                        ax[ix//height][ix%height].clear()
-                        for s in ind:
-                            ax[ix//height][ix%height].plot(range(len(s)), s)
-                    plt.pause(0.001)
-                    if self.plot == 'notebook': 
-                        plt.show()
-
+                    f, ax = plt.subplots(4, height, sharex=True)
                 else:
-                    plt.clf()
-                    for shap in best_ind:
-                        plt.plot(range(len(shap)), shap)
-                    plt.pause(0.001)
-
-            # Iterate over all individuals and apply CX with certain prob
-            start = time.time()
-            for child1, child2 in zip(offspring[::2], offspring[1::2]):
-                for cx_op in deap_cx_ops:
-                    if np.random.random() < self.crossover_prob:
-                        cx_op(child1, child2)
-                        del child1.fitness.values
-                        del child2.fitness.values
-
-            # Apply mutation to each individual
-            start = time.time()
-            for idx, indiv in enumerate(offspring):
-                for mut_op in deap_mut_ops:
-                    if np.random.random() < self.mutation_prob:
-                        mut_op(indiv, toolbox)
-                        del indiv.fitness.values
-
-            # Update the fitness values
-            start = time.time()
-            invalid_ind = [ind for ind in offspring if not ind.fitness.valid]
-            fitnesses = toolbox.map(toolbox.evaluate, invalid_ind)
-            for ind, fit in zip(invalid_ind, fitnesses):
-                ind.fitness.values = fit
-
-            # Replace population and update hall of fame, statistics & history
-            start = time.time()
-            new_pop = toolbox.select(offspring, self.population_size - 1)
-            fittest_ind = tools.selBest(pop + offspring, 1)
-            pop[:] = new_pop + fittest_ind
-            it_stats = stats.compile(pop)
-            self.history.append([it, it_stats])
-
-            # Print our statistics
-            if self.verbose:
-                if it == 1:
-                    # Print the header of the statistics
-                    print('it\t\tavg\t\tstd\t\tmax\t\ttime')
-
-                print('{}\t\t{}\t\t{}\t\t{}\t{}'.format(
-                    it, 
-                    np.around(it_stats['avg'], 4), 
-                    np.around(it_stats['std'], 3), 
-                    np.around(it_stats['max'], 6),
-                    np.around(time.time() - gen_start, 4), 
-                ))
-
-            # Have we found a new best score?
-            if it_stats['max'] > best_score:
-                best_it = it
-                best_score = it_stats['max']
-                best_ind = tools.selBest(pop + offspring, 1)
-                self.fitness(X, y, best_ind[0], verbose=True, cache=cache)
-
-                # Overwrite self.shapelets everytime so we can
-                # pre-emptively stop the genetic algorithm
-                best_shapelets = []
-                for shap in best_ind[0]:
-                    best_shapelets.append(shap.flatten())
-                self.shapelets = best_shapelets
-
-
-            it += 1
+                    plt.figure(figsize=(15, 5))
+                    plt.xlim([0, len(X[0])])
+
+            # The genetic algorithm starts here
+            while it <= self.iterations and it - best_it < self.wait:
+                gen_start = time.time()
+
+                # Individuals are only cloned right before they are modified,
+                # unchanged offspring share the individual with the population
+                offspring = list(pop)
+                cloned = set()
+
+                def clone_offspring(ix):
+                    """Clone offspring[ix] the first time it gets modified"""
+                    if ix not in cloned:
+                        offspring[ix] = toolbox.clone(offspring[ix])
+                        cloned.add(ix)
+                    return offspring[ix]
+
+                # Plot the fittest individual of our population
+                if self.plot is not None:
+                    if self.population_size <= 20:
+                        if self.plot == 'notebook':
+                            f, ax = plt.subplots(4, height, sharex=True)
+                        for ix, ind in enumerate(offspring):
+                            ax[ix//height][ix%height].clear()
+                            for s in ind:
+                                ax[ix//height][ix%height].plot(range(len(s)), s)
+                        plt.pause(0.001)
+                        if self.plot == 'notebook': 
+                            plt.show()
+
+                    else:
+                        plt.clf()
+                        for shap in best_ind:
+                            plt.plot(range(len(shap)), shap)
+                        plt.pause(0.001)
+
+                # Iterate over all individuals and apply CX with certain prob.
+                # The decisions for all (pair, operator) combinations are
+                # drawn at once, in the same order as they are applied.
+                start = time.time()
+                cx_draws = np.random.random((len(offspring) // 2,
+                                             len(deap_cx_ops)))
+                for pair_ix, op_ix in zip(*np.nonzero(
+                        cx_draws < self.crossover_prob)):
+                    child1 = clone_offspring(2 * pair_ix)
+                    child2 = clone_offspring(2 * pair_ix + 1)
+                    deap_cx_ops[op_ix](child1, child2)
+                    del child1.fitness.values
+                    del child2.fitness.values
+
+                # Apply mutation to each individual
+                start = time.time()
+                mut_draws = np.random.random((len(offspring),
+                                              len(deap_mut_ops)))
+                for ix, op_ix in zip(*np.nonzero(
+                        mut_draws < self.mutation_prob)):
+                    indiv = clone_offspring(ix)
+                    deap_mut_ops[op_ix](indiv, toolbox)
+                    del indiv.fitness.values
+
+                # Update the fitness values
+                start = time.time()
+                # Only the cloned offspring were modified by an operator
+                invalid_ind = [offspring[ix] for ix in sorted(cloned)]
+                _set_fitness_values(invalid_ind, toolbox.evaluate(invalid_ind),
+                                    weights)
+
+                # Replace population and update hall of fame, statistics & history
+                start = time.time()
+                new_pop = toolbox.select(offspring, self.population_size - 1)
+                fittest_ind = _select_fittest(pop + offspring)
+                pop[:] = new_pop + [fittest_ind]
+                it_stats = stats.compile(pop)
+                self.history.append([it, it_stats])
+
+                # Print our statistics
+                if self.verbose:
+                    if it == 1:
+                        # Print the header of the statistics
+                        print('it\t\tavg\t\tstd\t\tmax\t\ttime')
+
+                    print('{}\t\t{}\t\t{}\t\t{}\t{}'.format(
+                        it, 
+                        np.around(it_stats['avg'], 4), 
+                        np.around(it_stats['std'], 3), 
+                        np.around(it_stats['max'], 6),
+                        np.around(time.time() - gen_start, 4), 
+                    ))
+
+                # Have we found a new best score?
+                if it_stats['max'] > best_score:
+                    best_it = it
+                    best_score = it_stats['max']
+                    # The elite is the fittest of the population and offspring
+                    best_ind = [fittest_ind]
+                    self.fitness(X, y, best_ind[0], verbose=True, cache=cache)
+
+                    # Overwrite self.shapelets everytime so we can
+                    # pre-emptively stop the genetic algorithm
+                    best_shapelets = []
+                    for shap in best_ind[0]:
+                        best_shapelets.append(shap.flatten())
+                    self.shapelets = best_shapelets
+
+                # Stop when all individuals have (nearly) the same fitness,
+                # or when the average has been within 1% of the maximum for
+                # the last `wait` generations
+                recent_fitness.append((it_stats['max'], it_stats['avg']))
+                if it_stats['max'] - it_stats['min'] < 1e-9:
+                    if self.verbose:
+                        print('Stopping: all fitness values are equal')
+                    break
+                if (len(recent_fitness) == self.wait and
+                        all(m - a < 0.01 * abs(m) for m, a in recent_fitness)):
+                    if self.verbose:
+                        print('Stopping: average fitness converged to max')
+                    break
+
+                it += 1
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if shm is not None:
+                shm.close()
+                shm.unlink()
 
         best_shapelets = []
         for shap in best_ind[0]:
@@ -2,31 +2,138 @@ import numpy as np
 cimport numpy as np
 import math
 import cython
+from libc.math cimport sqrt, INFINITY
 np.import_array()
 DTYPE = np.float64
 ctypedef np.float64_t DTYPE_t
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def _pdist(np.ndarray[DTYPE_t, ndim=2] A,
-           list B,
-           np.ndarray[DTYPE_t, ndim=2] result):
+cdef double _centre(double[::1] ts, double[::1] centred,
+                    double[::1] cum_sq) nogil:
+    """Write `ts` minus its mean to `centred` and the running sum of squares
+    of the result to `cum_sq` (with cum_sq[0] = 0). Returns the mean."""
+    cdef Py_ssize_t k
+    cdef Py_ssize_t n = ts.shape[0]
+    cdef double mean = 0
+    for k in range(n):
+        mean += ts[k]
+    mean /= n
+    cum_sq[0] = 0
+    for k in range(n):
+        centred[k] = ts[k] - mean
+        cum_sq[k + 1] = cum_sq[k] + centred[k] * centred[k]
+    return mean
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double _min_sq_dist(double[::1] ts, double[::1] centred,
+                         double[::1] cum_sq, double mean,
+                         double[::1] flat, Py_ssize_t offset, Py_ssize_t m,
+                         double[::1] shap_buf, Py_ssize_t* loc) nogil:
+    """Minimal squared euclidean distance between the shapelet stored at
+    flat[offset:offset+m] and every window of `ts`.
+
+    The best window is searched with ||w - s||^2 = sum(w^2) - 2*(w . s) +
+    sum(s^2), where the window sums of squares are differences of the
+    running sum `cum_sq`, so only the dot product is computed per window.
+    To limit cancellation, the series and shapelet are both shifted by the
+    mean of the series, which does not change their distance. The distance
+    of the best window is then recomputed exactly from `ts`. The index of
+    that window is written to `loc`."""
+    cdef Py_ssize_t n = ts.shape[0]
+    cdef Py_ssize_t m4 = m - m % 4
+    cdef Py_ssize_t k, l
+    cdef double shap_sq = 0
+    cdef double min_sq_dist = INFINITY
+    cdef double dot0, dot1, dot2, dot3, sq_dist, diff
+    cdef double* w
+    cdef double* s = &flat[offset]
+    cdef double* c = &shap_buf[0]
+
+    for l in range(m):
+        c[l] = s[l] - mean
+        shap_sq += c[l] * c[l]
+
+    loc[0] = 0
+    for k in range(n - m + 1):
+        # Unrolled by four with independent accumulators, so the compiler
+        # can vectorize the dot product without a dependency chain
+        w = &centred[k]
+        dot0 = dot1 = dot2 = dot3 = 0
+        for l in range(0, m4, 4):
+            dot0 += w[l] * c[l]
+            dot1 += w[l + 1] * c[l + 1]
+            dot2 += w[l + 2] * c[l + 2]
+            dot3 += w[l + 3] * c[l + 3]
+        for l in range(m4, m):
+            dot0 += w[l] * c[l]
+        sq_dist = (cum_sq[k + m] - cum_sq[k]
+                   - 2 * ((dot0 + dot1) + (dot2 + dot3)) + shap_sq)
+        if sq_dist < min_sq_dist:
+            min_sq_dist = sq_dist
+            loc[0] = k
+
+    # Recompute the distance of the best window directly
+    w = &ts[loc[0]]
+    min_sq_dist = 0
+    for l in range(m):
+        diff = w[l] - s[l]
+        min_sq_dist += diff * diff
+    return min_sq_dist
 
-    cdef int i, j, k
-    cdef int nA = len(A)
-    cdef int nB = len(B)
+def _pack_shapelets(list B):
+    """Concatenate a list of shapelets into one contiguous buffer, together
+    with the offset and length of every shapelet in that buffer"""
+    shapelets = [np.ravel(b) for b in B]
+    lengths = np.array([len(b) for b in shapelets], dtype=np.intp)
+    offsets = np.zeros(len(shapelets), dtype=np.intp)
+    offsets[1:] = np.cumsum(lengths)[:-1]
+    if len(shapelets):
+        flat = np.ascontiguousarray(np.concatenate(shapelets), dtype=DTYPE)
+    else:
+        flat = np.empty(0, dtype=DTYPE)
+    return flat, offsets, lengths
 
-    cdef float dist, min_dist
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _pdist_packed(np.ndarray[DTYPE_t, ndim=2] A,
+                  double[::1] flat,
+                  Py_ssize_t[::1] offsets,
+                  Py_ssize_t[::1] lengths,
+                  np.ndarray[DTYPE_t, ndim=2] result):
+    """Same as `_pdist`, but with the shapelets packed by `_pack_shapelets`"""
+    cdef Py_ssize_t i, j
+    cdef Py_ssize_t nA = A.shape[0]
+    cdef Py_ssize_t nB = offsets.shape[0]
+
+    cdef double[:, ::1] ts = np.ascontiguousarray(A)
+    cdef double[:, :] res = result
+    cdef double[::1] centred = np.empty(A.shape[1], dtype=DTYPE)
+    cdef double[::1] cum_sq = np.empty(A.shape[1] + 1, dtype=DTYPE)
+    cdef double[::1] shap_buf = np.empty(np.max(lengths, initial=1),
+                                         dtype=DTYPE)
+    cdef double mean
+    cdef Py_ssize_t loc
 
-    for i in xrange(nA):
-        for j in xrange(nB):
-            if result[i, j] == 0:
-                min_dist = np.inf
-                for k in xrange(len(A[i]) - len(B[j]) + 1):
-                    dist = np.sqrt(np.sum((A[i, k:k+len(B[j])] - B[j])**2))
-                    if dist < min_dist:
-                        min_dist = dist
-                result[i, j] = min_dist
+    with nogil:
+        for i in range(nA):
+            mean = _centre(ts[i], centred, cum_sq)
+            for j in range(nB):
+                if res[i, j] == 0:
+                    if lengths[j] > ts.shape[1]:
+                        res[i, j] = INFINITY
+                    else:
+                        res[i, j] = sqrt(_min_sq_dist(ts[i], centred, cum_sq,
+                                                      mean, flat, offsets[j],
+                                                      lengths[j], shap_buf,
+                                                      &loc))
+
+def _pdist(np.ndarray[DTYPE_t, ndim=2] A,
+           list B,
+           np.ndarray[DTYPE_t, ndim=2] result):
+    flat, offsets, lengths = _pack_shapelets(B)
+    _pdist_packed(A, flat, offsets, lengths, result)
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
@@ -35,21 +142,35 @@ def _pdist_location(np.ndarray[DTYPE_t, ndim=2] A,
                     np.ndarray[DTYPE_t, ndim=2] distances,
                     np.ndarray[DTYPE_t, ndim=2] locations):
 
-    cdef int i, j, k
-    cdef int nA = len(A)
-    cdef int nB = len(B)
-
-    cdef float dist, min_dist, loc
-
-    for i in xrange(nA):
-        for j in xrange(nB):
-            if distances[i, j] == 0:
-                min_dist = np.inf
-                loc = 0
-                for k in xrange(len(A[i]) - len(B[j]) + 1):
-                    dist = np.sqrt(np.sum((A[i, k:k+len(B[j])] - B[j])**2))
-                    if dist < min_dist:
-                        min_dist = dist
-                        loc = k/float(len(A[i]) - len(B[j]))
-                distances[i, j] = min_dist
-                locations[i, j] = loc
+    cdef Py_ssize_t i, j
+    cdef Py_ssize_t nA = A.shape[0]
+    cdef Py_ssize_t nB = len(B)
+
+    cdef double[::1] flat
+    cdef Py_ssize_t[::1] offsets, lengths
+    flat, offsets, lengths = _pack_shapelets(B)
+
+    cdef double[:, ::1] ts = np.ascontiguousarray(A)
+    cdef double[:, :] dist = distances
+    cdef double[:, :] locs = locations
+    cdef double[::1] centred = np.empty(A.shape[1], dtype=DTYPE)
+    cdef double[::1] cum_sq = np.empty(A.shape[1] + 1, dtype=DTYPE)
+    cdef double[::1] shap_buf = np.empty(np.max(lengths, initial=1),
+                                         dtype=DTYPE)
+    cdef double mean
+    cdef Py_ssize_t loc
+
+    with nogil:
+        for i in range(nA):
+            mean = _centre(ts[i], centred, cum_sq)
+            for j in range(nB):
+                if dist[i, j] == 0:
+                    if lengths[j] > ts.shape[1]:
+                        dist[i, j] = INFINITY
+                        locs[i, j] = 0
+                    else:
+                        dist[i, j] = sqrt(_min_sq_dist(ts[i], centred, cum_sq,
+                                                       mean, flat, offsets[j],
+                                                       lengths[j], shap_buf,
+                                                       &loc))
+                        locs[i, j] = loc / <double>(ts.shape[1] - lengths[j])
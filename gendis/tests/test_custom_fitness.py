@@ -46,4 +46,11 @@ def test_f1_fitness():
 	X, y = random_walk_blobs(n_ts_per_blob=20, sz=64, noise_level=0.1)
 	X = np.reshape(X, (X.shape[0], X.shape[1]))
 	extractor = GeneticExtractor(iterations=5, n_jobs=1, population_size=10, fitness=f1_fitness)
-	extractor.fit(X, y)
\ No newline at end of file
+	extractor.fit(X, y)
+
+def test_f1_fitness_parallel():
+	X, y = random_walk_blobs(n_ts_per_blob=20, sz=64, noise_level=0.1)
+	X = np.reshape(X, (X.shape[0], X.shape[1]))
+	extractor = GeneticExtractor(iterations=5, n_jobs=2, population_size=10, fitness=f1_fitness)
+	extractor.fit(X, y)
+	assert len(extractor.shapelets) > 0
@@ -0,0 +1,108 @@
+import sys
+sys.path.append('..')
+from tslearn.generators import random_walk_blobs
+import numpy as np
+from deap import base, creator, tools
+
+try:
+	from genetic import (GeneticExtractor, LRUCache, _eval_population,
+	                     _select_fittest)
+	from fitness import logloss_fitness, logloss_fitness_location
+except:
+	from gendis.genetic import (GeneticExtractor, LRUCache, _eval_population,
+	                            _select_fittest)
+	from gendis.fitness import logloss_fitness, logloss_fitness_location
+
+def random_population(X, n_individuals=4, n_shapelets=3):
+	"""Individuals of random subsequences, where consecutive individuals
+	share a shapelet so that some distances come from the cache"""
+	rng = np.random.RandomState(1337)
+	shapelets = []
+	for _ in range(n_individuals * (n_shapelets - 1) + 1):
+		ts = X[rng.randint(len(X))]
+		length = rng.randint(4, 20)
+		start = rng.randint(len(ts) - length)
+		shapelets.append(ts[start:start + length].reshape(-1, 1))
+	step = n_shapelets - 1
+	return [shapelets[i * step:i * step + n_shapelets]
+	        for i in range(n_individuals)]
+
+def check_eval_population(fitness):
+	np.random.seed(1337)
+	X, y = random_walk_blobs(n_ts_per_blob=10, sz=64, noise_level=0.1)
+	X = np.reshape(X, (X.shape[0], X.shape[1]))
+	y = y.reshape(-1, 1)
+	population = random_population(X)
+
+	cache = LRUCache(2048)
+	expected = [fitness(X, y, shaps, cache=cache) for shaps in population]
+	fitnesses = _eval_population(X, y, population, fitness, LRUCache(2048))
+	np.testing.assert_allclose(fitnesses, expected)
+
+def test_eval_population_logloss():
+	check_eval_population(logloss_fitness)
+
+def test_eval_population_logloss_location():
+	check_eval_population(logloss_fitness_location)
+
+def constant_fitness(X, y, shapelets, verbose=False, cache=None):
+	return (1.0, 1.0)
+
+class IncreasingFitness:
+	"""Every evaluation scores slightly higher than the previous one, so the
+	maximum keeps improving while the average stays within 1% of it"""
+	def __init__(self):
+		self.n_calls = 0
+
+	def __call__(self, X, y, shapelets, verbose=False, cache=None):
+		self.n_calls += 1
+		return (100.0 + 1e-3 * self.n_calls, 1.0)
+
+def random_data():
+	np.random.seed(1337)
+	X, y = random_walk_blobs(n_ts_per_blob=10, sz=64, noise_level=0.1)
+	return np.reshape(X, (X.shape[0], X.shape[1])), y
+
+def test_stop_when_fitness_values_equal():
+	X, y = random_data()
+	extractor = GeneticExtractor(iterations=10, wait=5, n_jobs=1,
+	                             population_size=10, fitness=constant_fitness)
+	extractor.fit(X, y)
+	assert len(extractor.history) == 1
+	assert len(extractor.shapelets) > 0
+
+def test_stop_when_average_converged():
+	X, y = random_data()
+	extractor = GeneticExtractor(iterations=20, wait=3, n_jobs=1,
+	                             population_size=10,
+	                             fitness=IncreasingFitness())
+	extractor.fit(X, y)
+	assert len(extractor.history) == 3
+	assert len(extractor.shapelets) > 0
+
+creator.create("FitnessTest", base.Fitness, weights=(1.0, -1.0))
+creator.create("IndividualTest", list, fitness=creator.FitnessTest)
+
+def check_select_fittest(values):
+	population = []
+	for ix, ind_values in enumerate(values):
+		ind = creator.IndividualTest([ix])
+		ind.fitness.values = ind_values
+		population.append(ind)
+	assert _select_fittest(population) is tools.selBest(population, 1)[0]
+
+def test_select_fittest():
+	rng = np.random.RandomState(1337)
+	for _ in range(500):
+		n = rng.randint(1, 12)
+		# Few distinct values, so there are ties on the first objective
+		# and on both objectives
+		values = [(float(rng.randint(3)), float(rng.randint(3)))
+		          for _ in range(n)]
+		check_select_fittest(values)
+
+		# A NaN in one of the objectives
+		ix, col = rng.randint(n), rng.randint(2)
+		values[ix] = tuple(np.nan if c == col else v
+		                   for c, v in enumerate(values[ix]))
+		check_select_fittest(values)
@@ -72,4 +72,12 @@ def test_accept_string_labels():
 	y = ['a', 'a', 'a', 'a', 'b', 'b', 'b', 'b']
 
 	genetic = GeneticExtractor(population_size=5, iterations=5)
-	genetic.fit(X, y)
\ No newline at end of file
+	genetic.fit(X, y)
+
+def test_convert_X_casts_instead_of_reinterpreting():
+	X = np.array([[0, 1, 2, 3, 4], [5, 6, 7, 8, 9]])
+
+	genetic = GeneticExtractor()
+	np.testing.assert_array_equal(genetic._convert_X(X), X.astype(float))
+	np.testing.assert_array_equal(genetic._convert_X(X.astype(np.float32)),
+	                              X.astype(float))
@@ -0,0 +1,59 @@
+import sys
+sys.path.append('..')
+import numpy as np
+
+try:
+	from pairwise_dist import _pdist, _pdist_location
+except:
+	from gendis.pairwise_dist import _pdist, _pdist_location
+
+def brute_force(A, B):
+	"""Scan every window of every timeseries directly with numpy"""
+	D = np.zeros((len(A), len(B)))
+	L = np.zeros((len(A), len(B)))
+	for i, ts in enumerate(A):
+		for j, shap in enumerate(B):
+			if len(shap) > len(ts):
+				D[i, j] = np.inf
+				continue
+			dists = [np.sqrt(np.sum((ts[k:k+len(shap)] - shap)**2))
+			         for k in range(len(ts) - len(shap) + 1)]
+			D[i, j] = np.min(dists)
+			L[i, j] = np.argmin(dists) / float(len(ts) - len(shap))
+	return D, L
+
+def random_data(offset=0.0):
+	rng = np.random.RandomState(1337)
+	A = offset + rng.randn(20, 50).cumsum(axis=1)
+	B = [rng.randn(m).cumsum() + offset for m in [4, 7, 13, 25, 49]]
+	# An exact subsequence and a shapelet longer than the timeseries
+	B += [A[3, 10:22].copy(), rng.randn(60)]
+	return A, B
+
+def test_pdist():
+	A, B = random_data()
+	D = np.zeros((len(A), len(B)))
+	_pdist(A, B, D)
+	np.testing.assert_allclose(D, brute_force(A, B)[0], rtol=1e-9)
+	assert D[3, len(B) - 2] == 0
+
+def test_pdist_location():
+	A, B = random_data()
+	D = np.zeros((len(A), len(B)))
+	L = np.zeros((len(A), len(B)))
+	_pdist_location(A, B, D, L)
+	D_true, L_true = brute_force(A, B)
+	np.testing.assert_allclose(D, D_true, rtol=1e-9)
+	np.testing.assert_array_equal(L, L_true)
+
+def test_pdist_non_contiguous_result():
+	A, B = random_data()
+	D = np.zeros((len(B), len(A)))
+	_pdist(A, B, D.T)
+	np.testing.assert_allclose(D.T, brute_force(A, B)[0], rtol=1e-9)
+
+def test_pdist_large_offset():
+	A, B = random_data(offset=1e6)
+	D = np.zeros((len(A), len(B)))
+	_pdist(A, B, D)
+	np.testing.assert_allclose(D, brute_force(A, B)[0], rtol=1e-9)